@@ -0,0 +1,400 @@
+# file: tools/newsweek_bench.py
+"""Benchmark etapów newsweek_cache na lokalnym, sztucznym serwerze Newsweeka.
+
+Serwer podaje syntetyczny feed (/feed.xml?n=N) i strony artykułów z og:image
+w <head>; opóźnienie i rozmiar stron są konfigurowalne. Mierzymy czas,
+przepustowość i szczytową pamięć (tracemalloc) każdego etapu:
+
+  pipeline  – pełny przebieg dla N pozycji feedu (pusty magazyn),
+  store     – operacje na magazynie z M rekordami (bez sieci),
+  compare   – (--compare-async) run_feed kontra run_feed_async; różny
+              wynik kończy benchmark kodem 1.
+
+Z --check zamiast pomiarów idą kontrole poprawności (CHECKS); nieudana
+kończy się kodem 1.
+
+Przykład:
+  python tools/newsweek_bench.py --items 50 500 --store-sizes 1000 10000 --json bench.json
+  python tools/newsweek_bench.py --check order sqlite-import wal-stale wal-tail
+"""
+import argparse, asyncio, contextlib, io, json, os, random, sys, tempfile, threading, time, tracemalloc
+from datetime import timedelta
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import newsweek_cache as nc  # noqa: E402
+
+DESCRIPTION = ("Rząd przyjął projekt ustawy, który zmienia zasady finansowania "
+               "samorządów. Eksperci ostrzegają, że na zmianach stracą mniejsze gminy. ")
+
+# --- Sztuczny serwer ----------------------------------------------------------
+def bench_guid(i):
+    return f"00000000-0000-4000-8000-{i:012d}"
+
+def feed_xml(base_url, start, count, now=None):
+    """Syntetyczny RSS 2.0 z pozycjami start..start+count-1 (od najnowszej)."""
+    now = now or nc.now_utc()
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0"><channel>'
+             "<title>Newsweek (bench)</title><link>https://www.newsweek.pl/</link>"]
+    for i in range(start, start + count):
+        pub = format_datetime(now - timedelta(minutes=i))
+        parts.append(
+            f"<item><title>{escape(f'Artykuł numer {i} – ważne wiadomości')}</title>"
+            f"<link>{base_url}/article/{i}</link>"
+            f"<description><![CDATA[{DESCRIPTION * 2}]]></description>"
+            f'<enclosure url="{base_url}/img/{i}-small.jpg" length="1000" type="image/jpeg"/>'
+            f"<pubDate>{pub}</pubDate><guid>urn:uuid:{bench_guid(i)}</guid></item>")
+    parts.append("</channel></rss>")
+    return "".join(parts).encode("utf-8")
+
+def article_html(base_url, i, page_kb):
+    head = ("<!DOCTYPE html><html><head><meta charset=\"utf-8\">"
+            f"<title>Artykuł {i}</title>"
+            f'<meta property="og:image" content="{base_url}/img/{i}-big.jpg">'
+            '<meta property="og:image:width" content="1200">'
+            '<meta property="og:image:height" content="630">'
+            "</head><body>")
+    filler = "<p>" + DESCRIPTION * 8 + "</p>"
+    body = filler * max(1, page_kb * 1024 // len(filler.encode("utf-8")))
+    return (head + body + "</body></html>").encode("utf-8")
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # zerwane połączenia to norma (wczesne przerwanie czytania strony)
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+class FakeNewsweek:
+    """Lokalny serwer HTTP/1.1 z keep-alive udający newsweek.pl."""
+    def __init__(self, latency=0.0, page_kb=300):
+        bench = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(bench.latency)
+                parts = urlsplit(self.path)
+                if parts.path == "/feed.xml":
+                    n = int(parse_qs(parts.query).get("n", ["50"])[0])
+                    body, ctype = feed_xml(bench.base_url, 0, n, bench.now), "application/rss+xml"
+                elif parts.path.startswith("/article/"):
+                    i = int(parts.path.rsplit("/", 1)[-1])
+                    body, ctype = article_html(bench.base_url, i, bench.page_kb), "text/html"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", ctype + "; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # klient przerwał po </head> – tak ma być
+                    self.close_connection = True
+
+        self.server = QuietServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.latency = latency
+        self.page_kb = page_kb
+        self.now = nc.now_utc()  # stały zegar: każde pobranie feedu daje te same bajty
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+# --- Pomiar -------------------------------------------------------------------
+class Bench:
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.rows = []
+
+    def stage(self, scenario, size, name, count, fn, *args):
+        if self.memory:
+            tracemalloc.start()
+        t0 = time.perf_counter()
+        result = fn(*args)
+        seconds = time.perf_counter() - t0
+        peak = None
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.rows.append({
+            "scenario": scenario, "size": size, "stage": name, "seconds": round(seconds, 6),
+            "items_per_s": round(count / seconds, 1) if count and seconds else None,
+            "peak_bytes": peak,
+        })
+        return result
+
+    def report(self, out=sys.stdout):
+        out.write(f"{'scenario':<9} {'size':>8} {'stage':<18} {'seconds':>10} {'items/s':>12} {'peak MiB':>9}\n")
+        for r in self.rows:
+            ips = f"{r['items_per_s']:.0f}" if r["items_per_s"] else "-"
+            peak = f"{r['peak_bytes'] / 2**20:.1f}" if r["peak_bytes"] is not None else "-"
+            out.write(f"{r['scenario']:<9} {r['size']:>8} {r['stage']:<18} "
+                      f"{r['seconds']:>10.4f} {ips:>12} {peak:>9}\n")
+
+def bench_feed(tmp, name, url, backend):
+    return nc.Feed(name, url, store_path=os.path.join(tmp, f"{name}_store.json"),
+                   state_path=os.path.join(tmp, f"{name}_state.json"),
+                   output_path=os.path.join(tmp, f"{name}.xml"),
+                   sqlite_path=os.path.join(tmp, f"{name}_store.sqlite"),
+                   shard_dir=os.path.join(tmp, f"{name}_store"), backend=backend)
+
+def synthetic_items(start, count, base_url="https://www.newsweek.pl", chunk=10000):
+    """Pozycje w formacie extract_item_data, przepuszczone przez parser narzędzia."""
+    now = nc.now_utc()
+    for off in range(start, start + count, chunk):
+        xml = feed_xml(base_url, off, min(chunk, start + count - off), now)
+        yield [nc.extract_item_data(it, fetch_og=False) for it in nc.parse_rss_items(xml)]
+
+def run_pipeline(bench, server, tmp, n, backend):
+    url = f"{server.base_url}/feed.xml?n={n}"
+    feed = bench_feed(tmp, f"pipeline{n}", url, backend)
+    st = lambda name, fn, *a: bench.stage("pipeline", n, name, n, fn, *a)
+    xml = st("fetch_feed_xml", nc.fetch_feed_xml, url)
+    items = st("parse_rss_items", nc.parse_rss_items, xml)
+    parsed = st("extract_item_data", lambda: [nc.extract_item_data(it, fetch_og=False) for it in items])
+    cache = nc.EnrichmentCache()
+    st("enrich_items", nc.enrich_items, parsed, cache)
+    cache.close()
+    store = st("load_store", nc.load_store, feed)
+    st("prune_store", nc.prune_store, store, feed.retention_days)
+    st("upsert_items", nc.upsert_items, store, parsed)
+    st("save_store", nc.save_store, store)
+    st("build_rss", nc.build_rss, store, None, feed)
+    store.close()
+
+def run_store(bench, tmp, m, backend, batch=50):
+    feed = bench_feed(tmp, f"store{m}", "https://www.newsweek.pl/.feed", backend)
+    store = nc.load_store(feed)
+    for items in synthetic_items(batch, m):
+        nc.upsert_items(store, items)
+    nc.save_store(store)
+    store.close()
+    # przebieg jak w run_feed: połowa paczki nowa, połowa już w magazynie
+    fresh = next(synthetic_items(batch // 2, batch))
+    st = lambda name, count, fn, *a: bench.stage("store", m, name, count, fn, *a)
+    store = st("load_store", m, nc.load_store, feed)
+    st("prune_store", m, nc.prune_store, store, feed.retention_days)
+    st("upsert_items", batch, nc.upsert_items, store, fresh)
+    st("save_store", len(store), nc.save_store, store)
+    st("build_rss", len(store), nc.build_rss, store, None, feed)
+    store.close()
+
+def run_compare(bench, server, tmp, n, backend):
+    """Przebieg synchroniczny i asyncio na tym samym feedzie; True, gdy wynik jest zgodny."""
+    url = f"{server.base_url}/feed.xml?n={n}"
+    results = {}
+    for mode, run in (("sync", nc.run_feed), ("async", lambda f: asyncio.run(nc.run_feed_async(f)))):
+        feed = bench_feed(tmp, f"compare{n}{mode}", url, backend)
+        feed.title = f"compare{n}"  # tytuł domyślnie wynika z nazwy
+        bench.stage("compare", n, f"run_feed_{mode}", n, run, feed)
+        store = nc.load_store(feed)
+        items = [(r.guid, r.title, r.link, r.enclosure and r.enclosure.url, r.pub_date, r.og_ok)
+                 for r in store.newest_first()]
+        store.close()
+        with open(feed.output_path, "rb") as f:
+            results[mode] = (items, f.read())
+    (sync_items, sync_xml), (async_items, async_xml) = results["sync"], results["async"]
+    same = sync_items == async_items and sync_xml == async_xml
+    print(f"compare {n}: {len(sync_items)} items, "
+          f"{'identical' if same else 'MISMATCH'} (items {sync_items == async_items}, "
+          f"xml {sync_xml == async_xml})")
+    return same
+
+# --- Kontrole poprawności ----------------------------------------------------
+# Każda kontrola dostaje pusty katalog roboczy i zwraca opis błędu albo None.
+def check_wal_tail(tmp):
+    """Linia dziennika WalStore ucięta przy awarii nie może pochłonąć następnego zapisu."""
+    path = os.path.join(tmp, "wal_tail.json")
+    store = nc.WalStore(path, path + ".bak", compact_ratio=100)
+    for guid in ("a", "b"):  # pierwszy zapis tworzy snapshot, drugi idzie do dziennika
+        nc.upsert_items(store, [nc.Item(guid=guid, title=guid)])
+        store.save()
+    if not os.path.exists(store.log_path):
+        return "second save did not append to the log"
+    with open(store.log_path, "ab") as f:
+        f.write(b'{"seq": 99, "put": {"gu')
+    with contextlib.redirect_stderr(io.StringIO()):  # ostrzeżenie o uciętej linii jest oczekiwane
+        store = nc.WalStore(path, path + ".bak", compact_ratio=100)
+    nc.upsert_items(store, [nc.Item(guid="d", title="d")])
+    store.save()
+    guids = sorted(rec.guid for rec in nc.WalStore(path, path + ".bak").newest_first())
+    if guids != ["a", "b", "d"]:
+        return f"after reload the store holds {guids}, expected ['a', 'b', 'd']"
+    return None
+
+def check_wal_stale(tmp):
+    """Dziennik, który przetrwał przerwaną kompakcję, nie cofa nowszego snapshotu."""
+    path = os.path.join(tmp, "wal_stale.json")
+    store = nc.WalStore(path, path + ".bak", compact_ratio=100)
+    nc.upsert_items(store, [nc.Item(guid="a", title="v1")])
+    store.save()
+    nc.upsert_items(store, [nc.Item(guid="a", title="v2"), nc.Item(guid="b", title="b")])
+    store.save()
+    with open(store.log_path, "rb") as f:
+        stale = f.read()
+    nc.upsert_items(store, [nc.Item(guid="a", title="v3")])
+    store.compact()
+    with open(store.log_path, "wb") as f:  # awaria między zapisem snapshotu a usunięciem dziennika
+        f.write(stale)
+    titles = {rec.guid: rec.title for rec in nc.WalStore(path, path + ".bak").newest_first()}
+    if titles != {"a": "v3", "b": "b"}:
+        return f"stale log replayed over the snapshot: {titles}"
+    return None
+
+def check_sqlite_import(tmp):
+    """Nowa baza SQLite wypełniona z magazynu JSON ma te same rekordy w tej samej kolejności."""
+    feed = bench_feed(tmp, "import", "https://www.newsweek.pl/.feed", "json")
+    store = nc.load_store(feed)
+    for items in synthetic_items(0, 300, chunk=100):
+        nc.upsert_items(store, items[::2])
+        nc.upsert_items(store, items)  # druga połowa później, przeplatana w kolejności publikacji
+    for rec in list(store.newest_first())[::7]:  # zmiana daty przesuwa rekord między remisy
+        nc.upsert_items(store, [nc.Item.from_json({**rec.to_json(), "pubDate": None})])
+    store.save()
+    expected = [rec.to_json() for rec in store.newest_first()]
+    store.close()
+    feed.backend = "sqlite"
+    store = nc.load_store(feed)
+    got = [rec.to_json() for rec in store.newest_first()]
+    store.close()
+    if got != expected:
+        return f"imported {len(got)} records, expected {len(expected)}, or the order differs"
+    return None
+
+def check_order(tmp, seeds=300):
+    """Kolejność kanału na każdym backendzie jak stabilne sortowanie bazowej wersji.
+
+    Losowe upserty, zmiany dat publikacji, retencja i przeładowania magazynu.
+    """
+    epoch_now = nc.epoch_now
+    try:
+        for seed in range(seeds):
+            problem = order_run(os.path.join(tmp, str(seed)), seed)
+            if problem:
+                return f"seed {seed}: {problem}"
+    finally:
+        nc.epoch_now = epoch_now
+    return None
+
+def order_run(tmp, seed):
+    rnd = random.Random(seed)
+    os.makedirs(tmp)
+    # osobne ścieżki: pusty magazyn sharded/sqlite wczytałby plik json jako stary magazyn
+    feeds = {name: bench_feed(tmp, f"order_{name}", "https://www.newsweek.pl/.feed", name)
+             for name in sorted(nc.STORE_BACKENDS)}
+    stores = {name: nc.load_store(feed) for name, feed in feeds.items()}
+    try:
+        return order_steps(rnd, feeds, stores)
+    finally:
+        for store in stores.values():
+            store.close()
+
+def order_steps(rnd, feeds, stores):
+    model = {}  # guid -> (pub_date, fetched_at), w kolejności pierwszego dodania
+    base = 1_700_000_000
+    for step in range(12):
+        now = base + step * 3600 * rnd.choice([1, 5, 20])
+        nc.epoch_now = lambda: now
+        cutoff = now - 40 * 3600
+        for store in stores.values():
+            store.prune(cutoff)
+        model = {g: v for g, v in model.items() if v[1] >= cutoff}
+        batch = [(f"g{rnd.randint(0, 25)}",
+                  base + rnd.choice([0, 1, 2]) * 3600 if rnd.random() < 0.85 else None)
+                 for _ in range(rnd.randint(0, 10))]
+        for store in stores.values():
+            nc.upsert_items(store, [nc.Item(guid=g, pub_date=pd) for g, pd in batch])
+        for g, pd in batch:
+            model[g] = (pd, model[g][1] if g in model else now)
+        expected = [g for g, _ in sorted(model.items(), reverse=True,
+                                         key=lambda kv: kv[1][1] if kv[1][0] is None else kv[1][0])]
+        for name, store in stores.items():
+            got = [rec.guid for rec in store.newest_first()]
+            if got != expected:
+                return f"step {step}, backend {name}: {got} != {expected}"
+            if rnd.random() < 0.5:
+                store.save()
+                store.close()
+                stores[name] = nc.load_store(feeds[name])
+    return None
+
+CHECKS = {"wal-tail": check_wal_tail, "wal-stale": check_wal_stale,
+          "sqlite-import": check_sqlite_import, "order": check_order}
+
+def run_checks(names):
+    """Uruchamia wybrane kontrole; True, gdy wszystkie przeszły."""
+    ok = True
+    for name in names:
+        with tempfile.TemporaryDirectory(prefix="newsweek-check-") as tmp:
+            problem = CHECKS[name](tmp)
+        print(f"check {name}: {'ok' if problem is None else 'FAILED: ' + problem}")
+        ok = ok and problem is None
+    return ok
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    ap.add_argument("--items", type=int, nargs="*", default=[50, 500, 5000])
+    ap.add_argument("--store-sizes", type=int, nargs="*", default=[1000, 10000, 100000, 1000000])
+    ap.add_argument("--latency", type=float, default=0.02, help="opóźnienie serwera na żądanie [s]")
+    ap.add_argument("--page-kb", type=int, default=300, help="rozmiar strony artykułu [KiB]")
+    ap.add_argument("--backend", choices=sorted(nc.STORE_BACKENDS), default=nc.STORE_BACKEND)
+    ap.add_argument("--rate", type=float, default=0,
+                    help="limit żądań/s na host (0 = bez limitu, AIMD działa dalej)")
+    ap.add_argument("--no-memory", action="store_true", help="bez tracemalloc (czystsze czasy)")
+    ap.add_argument("--compare-async", action="store_true",
+                    help="porównaj run_feed z run_feed_async dla każdego --items")
+    ap.add_argument("--json", help="zapisz wyniki jako JSON")
+    ap.add_argument("--check", nargs="+", choices=sorted(CHECKS), metavar="NAME",
+                    help=f"zamiast pomiarów uruchom kontrole: {', '.join(sorted(CHECKS))}")
+    args = ap.parse_args(argv)
+    if args.check:
+        sys.exit(0 if run_checks(args.check) else 1)
+
+    nc.RATE_LIMIT_RPS = args.rate
+    nc.METRICS.reset()
+    bench = Bench(memory=not args.no_memory)
+    same = True
+    with tempfile.TemporaryDirectory(prefix="newsweek-bench-") as tmp:
+        with FakeNewsweek(args.latency, args.page_kb) as server:
+            for n in args.items:
+                run_pipeline(bench, server, tmp, n, args.backend)
+                if args.compare_async:
+                    same = run_compare(bench, server, tmp, n, args.backend) and same
+        report = nc.METRICS.report()
+        limits, counters = report["rate_limits"], report["counters"]
+        nc.HTTP_POOL.close()
+        for m in args.store_sizes:
+            run_store(bench, tmp, m, args.backend)
+    bench.report()
+    for host, values in limits.items():
+        print(f"limits {host}: {values}")
+    # przy stronach większych niż HTTP_DRAIN_MAX pobrania artykułów nie dzielą połączeń
+    print(f"connections: {counters.get('http_connections_opened', 0)} opened, "
+          f"{counters.get('http_connections_reused', 0)} reused, "
+          f"{counters.get('http_drained_bytes', 0)} B drained (HTTP_DRAIN_MAX {nc.HTTP_DRAIN_MAX})")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "json_codec": nc.JSON_CODEC, "results": bench.rows}, f, indent=1)
+    if not same:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,521 @@
 # file: tools/newsweek_cache.py
-import json, os, email.utils, re
-from datetime import datetime, timedelta, timezone
-from urllib.request import urlopen, Request
+import asyncio, bisect, codecs, contextvars, functools, hashlib, inspect, itertools, json, os, email.utils, re, sqlite3, ssl, struct, sys, tempfile, threading, time, zlib
+import http.client
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import urljoin, urlsplit
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape as xml_escape
 from html.parser import HTMLParser
 
+# Opcjonalne szybkie kodeki JSON dla magazynu; bez nich działa stdlib json.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import brotli  # opcjonalnie: kopie .br plików wyjściowych
+except ImportError:
+    brotli = None
+
+FEEDS_CONFIG = "feeds.json"  # rejestr feedów; bez pliku działa sam Newsweek
+FEED_WORKERS = 4       # ile feedów przetwarzamy równolegle
+RUN_REPORT_PATH = "docs/run_report.json"  # raport czasów i liczników przebiegu (poza gitem)
 FEED_URL = "https://www.newsweek.pl/.feed"
 STORE_PATH = "data/newsweek_store.json"
+STORE_BACKUP_PATH = STORE_PATH + ".bak"  # ostatni dobry magazyn (odzysk po awarii)
+STORE_BACKEND = "json"  # "json" (jeden plik), "wal" (plik + dziennik zmian), "sharded" (SHARD_DIR) albo "sqlite" (SQLITE_PATH)
+SQLITE_PATH = "data/newsweek_store.sqlite"
+SHARD_DIR = "data/newsweek_store"  # magazyn "sharded": plik na dzień + manifest.json
+WAL_COMPACT_RATIO = 0.5  # magazyn "wal": kompaktujemy, gdy dziennik przekroczy tę część snapshotu
+STATE_PATH = "data/newsweek_state.json"  # walidatory HTTP feedu (ETag/Last-Modified)
 OUTPUT_PATH = "docs/newsweek.xml"  # zapis do /docs (GitHub Pages)
+OUTPUT_GZIP = True     # obok każdego XML także .gz (bajtowo stały: mtime=0, bez nazwy pliku)
+OUTPUT_BROTLI = False  # oraz .br – wymaga modułu brotli
+DETERMINISTIC_OUTPUT = True  # lastBuildDate z najnowszej pozycji: ten sam magazyn = te same bajty
 RETENTION_DAYS = 7
+CURRENT_ITEMS = 0      # >0: RFC 5005 – bieżący XML z co najmniej tyloma najnowszymi pozycjami + dzienne archiwa
+ARCHIVE_BASE_URL = ""  # prefiks adresów stron archiwum w atom:link; pusty = adresy względne
+FEED_TITLE = "Newsweek – cache (5h, 7 dni)"
+FEED_LINK = "https://www.newsweek.pl/"
+FEED_DESCRIPTION = "Lustrzany cache jednego feedu, odświeżany co 5 godzin"
+ENRICH_WORKERS = 8     # ile stron artykułów pobieramy równolegle (og:image)
+ENRICH_DEADLINE = 120  # s – globalny limit czasu na cały etap og:image
+ENRICH_TTL_HOURS = 48  # po tylu godzinach udane og:image pobieramy ponownie
+OG_CHUNK_SIZE = 16 * 1024  # strony artykułów czytamy porcjami, tylko do </head>
+HTTP_POOL_SIZE = 8     # ile bezczynnych połączeń keep-alive trzymamy na host
+HTTP_MAX_REDIRECTS = 5
+HTTP_DRAIN_MAX = 128 * 1024  # B – tyle nieprzeczytanej reszty odpowiedzi dociągamy, by zachować połączenie
+RATE_LIMIT_RPS = 8.0     # żądań/s na host (kubełek żetonów); 0 = bez limitu
+RATE_LIMIT_BURST = 8     # pojemność kubełka
+RETRY_AFTER_MAX = 30     # s – najdłuższa pauza hosta po 429/503 z Retry-After
+HTTP_QUEUE_TIMEOUT = 60  # s – najdłuższe czekanie w kolejce hosta; ponad RETRY_AFTER_MAX, poniżej ENRICH_DEADLINE
+AIMD_START = 2           # początkowa liczba równoległych żądań na host
+AIMD_MAX = 8             # górna granica równoległych żądań na host
+AIMD_LATENCY_FACTOR = 3.0  # odpowiedź wolniejsza niż tyle × najszybsza to przeciążenie...
+AIMD_LATENCY_FLOOR = 0.5   # ...o ile trwała dłużej niż tyle sekund
+AIMD_COOLDOWN = 1.0      # s – najwyżej jedno zmniejszenie limitu w tym oknie
+USER_AGENT = "Mozilla/5.0 (RSS cache)"
+ASYNC_PIPELINE = False  # main() przez main_async (asyncio) zamiast puli wątków feedów
+
+# --- Rejestr feedów ------------------------------------------------------------
+class Feed:
+    """Jeden mirrorowany feed: źródło, własny magazyn, stan, wyjście i retencja.
+
+    Ścieżki domyślnie wynikają z nazwy (data/<name>_store.json,
+    data/<name>_state.json, docs/<name>.xml, data/<name>_store/).
+    """
+    def __init__(self, name, url, title=None, link=None, description=None,
+                 store_path=None, state_path=None, output_path=None, sqlite_path=None,
+                 retention_days=None, backend=None, shard_dir=None, current_items=None):
+        self.name = name
+        self.url = url
+        self.title = title or name
+        self.link = link or url
+        self.description = description or ""
+        self.store_path = store_path or f"data/{name}_store.json"
+        self.store_backup_path = self.store_path + ".bak"
+        self.state_path = state_path or f"data/{name}_state.json"
+        self.output_path = output_path or f"docs/{name}.xml"
+        self.sqlite_path = sqlite_path or f"data/{name}_store.sqlite"
+        self.shard_dir = shard_dir or f"data/{name}_store"
+        self.current_items = CURRENT_ITEMS if current_items is None else current_items
+        self.retention_days = retention_days or RETENTION_DAYS
+        self.backend = backend or STORE_BACKEND
+
+def default_feed():
+    """Feed Newsweeka zbudowany z ustawień modułu."""
+    return Feed("newsweek", FEED_URL, title=FEED_TITLE, link=FEED_LINK,
+                description=FEED_DESCRIPTION, store_path=STORE_PATH, state_path=STATE_PATH,
+                output_path=OUTPUT_PATH, sqlite_path=SQLITE_PATH,
+                retention_days=RETENTION_DAYS, backend=STORE_BACKEND, shard_dir=SHARD_DIR,
+                current_items=CURRENT_ITEMS)
+
+def load_feeds(path=FEEDS_CONFIG):
+    """Czyta rejestr feedów (lista obiektów JSON z polami jak w Feed)."""
+    if not os.path.exists(path):
+        return [default_feed()]
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    feeds = [Feed(**entry) for entry in entries]
+    names = [feed.name for feed in feeds]
+    if len(set(names)) != len(names):
+        raise ValueError(f"{path}: duplicate feed names")
+    return feeds
+
+# --- Metryki przebiegu --------------------------------------------------------
+class RunMetrics:
+    """Czasy etapów, liczniki i histogram statusów HTTP jednego przebiegu.
+
+    Bezpieczne wątkowo. Wszystko trafia do sekcji ogólnej, a wewnątrz
+    scope(nazwa_feedu) także do sekcji tego feedu. Czas etapu to suma czasów
+    wszystkich wywołań – równoległe wywołania (np. fetch_og_image) się sumują.
+    Zakres trzymamy w ContextVar, więc przechodzi też do zadań asyncio
+    i wywołań asyncio.to_thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = contextvars.ContextVar("metrics_scope", default=None)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = datetime.now(timezone.utc)
+            self.t0 = time.perf_counter()
+            self.totals = {"stages": {}, "counters": {}}
+            self.feeds = {}
+            self.http_status = {}
+            self.rate_limits = {}
+
+    def _sections(self):
+        name = self.current.get()
+        if name is None:
+            return (self.totals,)
+        return (self.totals, self.feeds.setdefault(name, {"stages": {}, "counters": {}}))
+
+    @contextmanager
+    def scope(self, name):
+        token = self.current.set(name)
+        try:
+            yield
+        finally:
+            self.current.reset(token)
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            with self.lock:
+                for sec in self._sections():
+                    st = sec["stages"].setdefault(name, {"calls": 0, "seconds": 0.0})
+                    st["calls"] += 1
+                    st["seconds"] += dt
+
+    def count(self, name, n=1):
+        with self.lock:
+            for sec in self._sections():
+                sec["counters"][name] = sec["counters"].get(name, 0) + n
+
+    def status(self, code):
+        with self.lock:
+            key = str(code)
+            self.http_status[key] = self.http_status.get(key, 0) + 1
+
+    def set_limits(self, host, values):
+        """Bieżące limity ogranicznika hosta (ostatnia wartość wygrywa)."""
+        with self.lock:
+            self.rate_limits[host] = dict(values)
+
+    def report(self):
+        def rounded(sec):
+            return {"stages": {k: {"calls": v["calls"], "seconds": round(v["seconds"], 4)}
+                               for k, v in sec["stages"].items()},
+                    "counters": dict(sec["counters"])}
+        with self.lock:
+            return {
+                "started_at": self.started.isoformat(),
+                "seconds": round(time.perf_counter() - self.t0, 4),
+                **rounded(self.totals),
+                "http_status": dict(self.http_status),
+                "rate_limits": {host: dict(v) for host, v in self.rate_limits.items()},
+                "feeds": {name: rounded(sec) for name, sec in self.feeds.items()},
+            }
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with atomic_write(path) as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=1, sort_keys=True)
+
+METRICS = RunMetrics()
+
+def timed(name):
+    """Dekorator: czas wywołań funkcji (także korutyn) trafia do METRICS jako etap name."""
+    def deco(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with METRICS.stage(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with METRICS.stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+# --- HTTP: pula połączeń keep-alive -----------------------------------------
+class HTTPStatusError(OSError):
+    """Odpowiedź z kodem >= 400 (odpowiednik urllib.error.HTTPError)."""
+    def __init__(self, url, status, reason=""):
+        super().__init__(f"HTTP {status} {reason} for {url}".strip())
+        self.url = url
+        self.status = status
+
+class HostLimiter:
+    """Uprzejmość wobec jednego hosta: kubełek żetonów i AIMD liczby żądań naraz.
+
+    Kubełek (rate żądań/s, burst) ogranicza tempo. Limit równoległości rośnie
+    addytywnie (+1 na „okno” szybkich odpowiedzi), a spada o połowę po 429/503,
+    błędzie połączenia albo odpowiedzi wyraźnie wolniejszej niż najszybsza
+    widziana (AIMD_LATENCY_FACTOR, AIMD_LATENCY_FLOOR). Retry-After wstrzymuje
+    cały host. Bezpieczny wątkowo – czekają wątki wywołujące acquire.
+    """
+    def __init__(self, host, rate=RATE_LIMIT_RPS, burst=RATE_LIMIT_BURST,
+                 start=AIMD_START, max_limit=AIMD_MAX):
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.max_limit = max(1, max_limit)
+        self.limit = float(min(max(1, start), self.max_limit))
+        self.lowest = self.limit
+        self.inflight = 0
+        self.min_latency = None
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Czeka na miejsce i żeton; po timeout sekundach zgłasza TimeoutError."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.rate:
+                    self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if now < self.paused_until:
+                    wait_for = self.paused_until - now
+                elif self.inflight >= int(self.limit):
+                    wait_for = None
+                elif self.rate and self.tokens < 1:
+                    wait_for = (1 - self.tokens) / self.rate
+                else:
+                    if self.rate:
+                        self.tokens -= 1
+                    self.inflight += 1
+                    return
+                if deadline is not None:
+                    left = deadline - now
+                    if left <= 0:
+                        raise TimeoutError(f"rate limiter for {self.host} timed out")
+                    wait_for = left if wait_for is None else min(wait_for, left)
+                self.cond.wait(wait_for)
+
+    def release(self, latency=None, status=None, retry_after=None):
+        """Zwalnia miejsce; latency=None oznacza błąd połączenia."""
+        with self.cond:
+            self.inflight -= 1
+            now = time.monotonic()
+            if status in (429, 503):
+                METRICS.count("rate_limited")
+                self._decrease(now)
+                if retry_after and retry_after.strip().isdigit():
+                    pause = min(int(retry_after), RETRY_AFTER_MAX)
+                    self.paused_until = max(self.paused_until, now + pause)
+            elif latency is None:
+                self._decrease(now)
+            else:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if latency > max(self.min_latency * AIMD_LATENCY_FACTOR, AIMD_LATENCY_FLOOR):
+                    self._decrease(now)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+            values = {"concurrency": round(self.limit, 2), "lowest_concurrency": round(self.lowest, 2),
+                      "rate": self.rate, "min_latency": round(self.min_latency or 0, 4)}
+        METRICS.set_limits(self.host, values)
 
-os.makedirs(os.path.dirname(STORE_PATH), exist_ok=True)
-os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
+    def _decrease(self, now):
+        # seria wolnych odpowiedzi z jednego okna to jeden sygnał, nie kilka
+        if now - self.last_decrease < AIMD_COOLDOWN:
+            return
+        self.last_decrease = now
+        self.limit = max(1.0, self.limit / 2)
+        self.lowest = min(self.lowest, self.limit)
+        METRICS.count("aimd_backoff")
+
+class HTTPPool:
+    """Współdzielona pula połączeń http.client z keep-alive per host.
+
+    Zastępuje pary Request/urlopen: feed i wszystkie strony artykułów idą
+    przez te same połączenia, więc TCP+TLS zestawiamy raz na host, a nie
+    raz na żądanie. Bezpieczna wątkowo (używa jej enrich_items). Każde
+    żądanie przechodzi przez HostLimiter swojego hosta.
+    """
+    REDIRECTS = (301, 302, 303, 307, 308)
+    RETRY = (429, 503)  # jedna ponowna próba po pauzie hosta
+
+    def __init__(self, maxsize=HTTP_POOL_SIZE):
+        self.maxsize = maxsize
+        self._idle = {}  # (scheme, host, port) -> [połączenia]
+        self._limiters = {}  # host -> HostLimiter
+        self._lock = threading.Lock()
+        self._ssl = ssl.create_default_context()
+
+    def limiter(self, host):
+        with self._lock:
+            lim = self._limiters.get(host)
+            if lim is None:
+                lim = self._limiters[host] = HostLimiter(
+                    host, RATE_LIMIT_RPS, RATE_LIMIT_BURST, AIMD_START, AIMD_MAX)
+            return lim
+
+    def _connect(self, key, timeout):
+        METRICS.count("http_connections_opened")
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=timeout, context=self._ssl)
+        return http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _acquire(self, key, timeout):
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            return self._connect(key, timeout), False
+        METRICS.count("http_connections_reused")
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _release(self, key, conn, resp):
+        # połączenie wraca do puli tylko po przeczytaniu całej odpowiedzi; małą
+        # resztę (np. strony artykułu za </head>) dociągamy – to tańsze niż nowe TCP+TLS
+        if not resp.isclosed() and resp.length is not None and resp.length <= HTTP_DRAIN_MAX:
+            try:
+                METRICS.count("http_drained_bytes", len(resp.read()))
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                return
+        if resp.isclosed() and not resp.will_close:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.maxsize:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def _send(self, url, headers, timeout):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        hdrs = {"User-Agent": USER_AGENT, **(headers or {})}
+        conn, reused = self._acquire(key, timeout)
+        try:
+            conn.request("GET", path, headers=hdrs)
+            return key, conn, conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not reused:
+                raise
+        except BaseException:
+            conn.close()
+            raise
+        # serwer zamknął bezczynne połączenie – jedna próba na świeżym
+        conn = self._connect(key, timeout)
+        try:
+            conn.request("GET", path, headers=hdrs)
+            return key, conn, conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+
+    @contextmanager
+    def get(self, url, headers=None, timeout=30, queue_timeout=HTTP_QUEUE_TIMEOUT):
+        """GET z obsługą przekierowań; zwraca http.client.HTTPResponse.
+
+        Kody >= 400 zgłaszają HTTPStatusError, 304 trafia do wywołującego.
+        429/503 ponawiamy raz, gdy minie pauza hosta (Retry-After). timeout
+        dotyczy gniazda, queue_timeout czekania w ograniczniku hosta.
+        """
+        retried = False
+        for _ in range(HTTP_MAX_REDIRECTS + 2):
+            parts = urlsplit(url)
+            if parts.scheme.lower() not in ("http", "https") or not parts.hostname:
+                raise http.client.InvalidURL(f"not an absolute http(s) URL: {url!r}")
+            limiter = self.limiter(parts.hostname)
+            with METRICS.stage("rate_limit_wait"):
+                limiter.acquire(queue_timeout)
+            t0 = time.monotonic()
+            try:
+                key, conn, resp = self._send(url, headers, timeout)
+            except BaseException as e:
+                # miejsce w ograniczniku wraca przy każdym błędzie, inaczej host się zatka
+                limiter.release()
+                if isinstance(e, (OSError, http.client.HTTPException)):
+                    METRICS.count("http_errors")
+                raise
+            latency = time.monotonic() - t0  # do nagłówków odpowiedzi
+            try:
+                METRICS.status(resp.status)
+                location = resp.getheader("Location")
+                if resp.status in self.REDIRECTS and location:
+                    resp.read()
+                    self._release(key, conn, resp)
+                    url = urljoin(url, location)
+                    continue
+                if resp.status in self.RETRY and not retried:
+                    # release w finally ustawia pauzę, a acquire następnej próby na nią czeka
+                    resp.read()
+                    self._release(key, conn, resp)
+                    retried = True
+                    METRICS.count("http_retries")
+                    continue
+                if resp.status >= 400:
+                    resp.read()
+                    self._release(key, conn, resp)
+                    raise HTTPStatusError(url, resp.status, resp.reason)
+                try:
+                    yield resp
+                finally:
+                    self._release(key, conn, resp)
+                return
+            finally:
+                limiter.release(latency, resp.status, resp.getheader("Retry-After"))
+        raise HTTPStatusError(url, resp.status, "too many redirects")
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            self._limiters = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+HTTP_POOL = HTTPPool()
 
 # --- HTML utils: og:image -----------------------------------------------------
+OG_PROPS = ("og:image", "og:image:width", "og:image:height")
+
 class MetaGrabber(HTMLParser):
-    """Minimalny parser do pobrania og:image (+ opcjonalnie width/height)."""
+    """Minimalny parser do pobrania og:image (+ opcjonalnie width/height).
+
+    Ustawia done, gdy ma komplet meta albo skończył się <head> – dalszej
+    części strony nie trzeba już czytać.
+    """
     def __init__(self):
         super().__init__()
         self.meta = {}
+        self.done = False
 
     def handle_starttag(self, tag, attrs):
-        if tag.lower() != "meta":
+        tag = tag.lower()
+        if tag == "body":
+            self.done = True
+            return
+        if tag != "meta":
             return
         d = dict(attrs)
         prop = (d.get("property") or d.get("name") or "").strip().lower()
-        if prop in ("og:image", "og:image:width", "og:image:height"):
+        if prop in OG_PROPS:
             self.meta[prop] = d.get("content")
+            if all(self.meta.get(k) for k in OG_PROPS):
+                self.done = True
 
+    def handle_endtag(self, tag):
+        if tag.lower() == "head":
+            self.done = True
+
+def grab_og_meta(resp, chunk_size=OG_CHUNK_SIZE):
+    """Czyta odpowiedź porcjami i przerywa, gdy MetaGrabber ma już wszystko."""
+    p = MetaGrabber()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while not p.done:
+        chunk = resp.read(chunk_size)
+        METRICS.count("og_bytes", len(chunk))
+        if not chunk:
+            p.feed(decoder.decode(b"", final=True))
+            break
+        p.feed(decoder.decode(chunk))
+    return p.meta
+
+@timed("fetch_og_image")
 def fetch_og_image(url: str):
     """Pobiera adres dużego obrazka z meta og:image strony artykułu."""
     if not url:
         return None
     try:
-        req = Request(url, headers={"User-Agent": "Mozilla/5.0 (RSS cache)"})
-        with urlopen(req, timeout=20) as resp:
-            html = resp.read().decode("utf-8", errors="replace")
-        p = MetaGrabber()
-        p.feed(html)
-        og = (p.meta.get("og:image") or "").strip()
+        with HTTP_POOL.get(url, timeout=20) as resp:
+            meta = grab_og_meta(resp)
+        og = (meta.get("og:image") or "").strip()
         if not og:
             return None
         # MIME po rozszerzeniu w URL (prosta heurystyka)
@@ -48,36 +525,645 @@ def fetch_og_image(url: str):
             guessed_type = "image/webp"
         elif lower.endswith(".png"):
             guessed_type = "image/png"
-        return {"url": og, "length": "", "type": guessed_type}
+        return Enclosure(og, "", guessed_type)
     except Exception:
         return None
 
+# --- JSON magazynu --------------------------------------------------------------
+# Magazyn czytamy i zapisujemy jako bajty: orjson albo msgspec, jeśli są
+# zainstalowane, inaczej stdlib. Wszystkie kodeki dają ten sam zwarty zapis
+# UTF-8, więc zmiana kodeka nie zmienia pliku (ani diffów w gicie).
+if orjson is not None:
+    JSON_CODEC = "orjson"
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+    JSON_DECODE_ERRORS = (orjson.JSONDecodeError,)
+elif msgspec is not None:
+    JSON_CODEC = "msgspec"
+    json_loads = msgspec.json.decode
+    json_dumps = msgspec.json.encode
+    JSON_DECODE_ERRORS = (msgspec.DecodeError,)
+else:
+    JSON_CODEC = "json"
+    json_loads = json.loads
+    JSON_DECODE_ERRORS = (ValueError,)
+
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
 # --- Czas i magazyn -----------------------------------------------------------
 def now_utc():
     return datetime.now(timezone.utc)
 
-def nowiso():
-    return now_utc().isoformat()
+# W rekordach czasy to liczby całkowite (epoch, UTC): fetched_at, pubDate,
+# og_checked_at. ISO/RFC 822 pojawia się tylko na brzegach (wejście feedu,
+# XML, migracja starych magazynów).
+def epoch_now():
+    return int(time.time())
+
+def to_epoch(dt):
+    return int(dt.timestamp())
+
+def json_epoch(v):
+    # magazyny sprzed czasów epoch trzymały ISO 8601
+    return to_epoch(datetime.fromisoformat(v)) if isinstance(v, str) else v
 
-def load_store():
-    if not os.path.exists(STORE_PATH):
-        return {}
-    with open(STORE_PATH, "r", encoding="utf-8") as f:
+# --- Rekordy ------------------------------------------------------------------
+class Enclosure:
+    __slots__ = ("url", "length", "type")
+
+    def __init__(self, url="", length="", type=""):
+        self.url = url
+        self.length = length
+        self.type = type
+
+    def __eq__(self, other):
+        return (isinstance(other, Enclosure)
+                and (self.url, self.length, self.type) == (other.url, other.length, other.type))
+
+    def to_json(self):
+        return {"url": self.url, "length": self.length, "type": self.type}
+
+    @classmethod
+    def from_json(cls, d):
+        return cls(d.get("url"), d.get("length"), d.get("type")) if d else None
+
+class Item:
+    """Pozycja feedu i zarazem rekord magazynu.
+
+    Klasa ze __slots__ zamiast słownika: przy długiej retencji i wielu
+    feedach nie powtarzamy kluczy w każdym rekordzie. Słowniki JSON pojawiają
+    się tylko na granicy z magazynem (to_json/from_json). seq to numer
+    dodania do magazynu (nadaje go JsonStore.put), jak fetched_at stały.
+    """
+    __slots__ = ("guid", "title", "link", "description", "enclosure",
+                 "pub_date_raw", "pub_date", "fetched_at", "og_checked_at", "og_ok", "seq")
+    # pola nadpisywane przy upsercie; og_* tylko, gdy nowa wersja je ma
+    UPDATED = ("title", "link", "description", "enclosure", "pub_date_raw", "pub_date")
+
+    def __init__(self, guid="", title="", link="", description="", enclosure=None,
+                 pub_date_raw="", pub_date=None, fetched_at=None, og_checked_at=None, og_ok=None,
+                 seq=None):
+        self.guid = guid
+        self.title = title
+        self.link = link
+        self.description = description
+        self.enclosure = enclosure
+        self.pub_date_raw = pub_date_raw
+        self.pub_date = pub_date
+        self.fetched_at = fetched_at
+        self.og_checked_at = og_checked_at
+        self.og_ok = og_ok
+        self.seq = seq
+
+    def __eq__(self, other):
+        return (isinstance(other, Item)
+                and all(getattr(self, k) == getattr(other, k) for k in self.__slots__))
+
+    def merged(self, newer):
+        """Kopia rekordu z treścią z nowszej wersji pozycji (guid, fetched_at i seq zostają)."""
+        rec = Item(**{k: getattr(self, k) for k in self.__slots__})
+        for k in self.UPDATED:
+            setattr(rec, k, getattr(newer, k))
+        if newer.og_checked_at is not None:
+            rec.og_checked_at = newer.og_checked_at
+            rec.og_ok = newer.og_ok
+        return rec
+
+    def to_json(self):
+        d = {"guid": self.guid, "title": self.title, "link": self.link,
+             "description": self.description,
+             "enclosure": self.enclosure.to_json() if self.enclosure else None,
+             "pubDate_raw": self.pub_date_raw, "pubDate": self.pub_date,
+             "fetched_at": self.fetched_at}
+        if self.og_checked_at is not None:
+            d["og_checked_at"] = self.og_checked_at
+            d["og_ok"] = self.og_ok
+        if self.seq is not None:
+            d["seq"] = self.seq
+        return d
+
+    @classmethod
+    def from_json(cls, d):
+        return cls(d.get("guid", ""), d.get("title", ""), d.get("link", ""),
+                   d.get("description", ""), Enclosure.from_json(d.get("enclosure")),
+                   d.get("pubDate_raw", ""), json_epoch(d.get("pubDate")),
+                   json_epoch(d.get("fetched_at")), json_epoch(d.get("og_checked_at")),
+                   d.get("og_ok"), d.get("seq"))
+
+def pub_sort_key(rec):
+    """Klucz kolejności w kanale: data publikacji, a bez niej fetched_at."""
+    return rec.pub_date if rec.pub_date is not None else rec.fetched_at
+
+# Pliki, których load_json nie zdołał odczytać: atomic_write nie przenosi ich
+# na kopię zapasową, żeby uszkodzona wersja nie nadpisała ostatniej dobrej.
+BROKEN_FILES = set()
+
+@contextmanager
+def atomic_write(path, backup_path=None, binary=False):
+    """Zapis do pliku tymczasowego obok path, fsync i atomowe os.replace.
+
+    Przerwany zapis nigdy nie zostawia uciętego pliku docelowego. Z backup_path
+    poprzednia wersja pliku jest przenoszona tam tuż przed podmianą – o ile
+    dała się odczytać (BROKEN_FILES).
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with (os.fdopen(fd, "wb") if binary else os.fdopen(fd, "w", encoding="utf-8")) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)
+        if backup_path and os.path.exists(path) and path not in BROKEN_FILES:
+            os.replace(path, backup_path)
+        os.replace(tmp, path)
+        BROKEN_FILES.discard(path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    # utrwalenie samej zmiany nazwy
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def load_json(path, backup_path=None):
+    """Czyta słownik JSON; uszkodzony lub brakujący plik zastępuje kopią zapasową."""
+    for candidate in (path, backup_path):
+        if not candidate or not os.path.exists(candidate):
+            continue
         try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            return {}
+            with open(candidate, "rb") as f:
+                data = json_loads(f.read())
+        except (OSError, ValueError, *JSON_DECODE_ERRORS) as e:
+            print(f"warning: cannot read {candidate}: {e}", file=sys.stderr)
+            BROKEN_FILES.add(candidate)
+            continue
+        if candidate != path:
+            print(f"warning: recovered {path} from {candidate}", file=sys.stderr)
+        return data
+    return {}
+
+# Backend magazynu: get/put/prune/newest_first/save/close. Rekordy to
+# obiekty Item z ustawionym fetched_at; resztę kodu nie obchodzi, gdzie
+# leżą. put dostaje zawsze nowy obiekt rekordu (nie zmieniony w miejscu
+# wynik get), żeby backend widział starą wersję. newest_first zwraca
+# iterowalne rekordy w kolejności kanału; build_rss woła je kilka razy
+# (każde wywołanie to nowe przejście), więc backend nie musi ich trzymać.
+STORE_FORMAT = 2  # {"format", "items", "pub_order"}; wersja 1 to goły słownik items
+
+class JsonStore:
+    """Cały magazyn jako jeden słownik guid -> rekord w pliku JSON.
+
+    Kolejność kluczy (w pamięci i w obiekcie JSON na dysku) to kolejność
+    fetched_at – rekordy tylko dopisujemy na końcu, a fetched_at po wstawieniu
+    się nie zmienia. To jest zapisany razem z magazynem indeks wygasania:
+    prune zdejmuje wyłącznie przeterminowaną głowę, bez skanu całości.
+    Rzadką wstawkę ze starszym fetched_at (np. cofnięty zegar) porządkuje
+    jednorazowe sortowanie przy prune albo przed zapisem.
+
+    Obok leży pub_order: guidy rosnąco wg (pub_sort_key, -seq), utrzymywane
+    wstawianiem binarnym. build_rss przechodzi je od końca zamiast sortować
+    magazyn. seq (numer dodania, zapisany w rekordzie) rozstrzyga remisy:
+    od końca wychodzi kolejność dodania, także dla rekordu przesuniętego po
+    zmianie daty – jak przy stabilnym sortowaniu i jak rowid w SqliteStore.
+    """
+    def __init__(self, path=STORE_PATH, backup_path=STORE_BACKUP_PATH):
+        self.path = path
+        self.backup_path = backup_path
+        self._load(load_json(path, backup_path))
+
+    def _load(self, raw):
+        if raw.get("format") == STORE_FORMAT:
+            items, order = raw["items"], raw["pub_order"]
+        else:
+            items, order = raw, None
+        self.data = {g: Item.from_json(d) for g, d in items.items()}
+        self.ordered = True
+        self.newest = None  # największe fetched_at w magazynie
+        self.next_seq = max((rec.seq for rec in self.data.values() if rec.seq is not None),
+                            default=-1) + 1
+        unnumbered = False
+        for rec in self.data.values():
+            if rec.seq is None:
+                # magazyn sprzed seq: kolejność w pliku to kolejność dodania
+                rec.seq = self.next_seq
+                self.next_seq += 1
+                unnumbered = True
+            # plik zapisany przed sortowaniem w snapshot może mieć wstawki "z przeszłości"
+            if self.newest is not None and rec.fetched_at < self.newest:
+                self.ordered = False
+            else:
+                self.newest = rec.fetched_at
+        if order is None or unnumbered or len(order) != len(self.data):
+            # stary format (albo niespójny plik) – jednorazowe sortowanie
+            order = sorted(self.data, key=lambda g: self._pub_key(self.data[g]))
+        self.pub_guids = order
+        self.pub_keys = [self._pub_key(self.data[g]) for g in order]
+
+    @staticmethod
+    def _pub_key(rec):
+        return (pub_sort_key(rec), -rec.seq)
+
+    def _pub_insert(self, guid, key):
+        i = bisect.bisect_left(self.pub_keys, key)
+        self.pub_keys.insert(i, key)
+        self.pub_guids.insert(i, guid)
+
+    def _pub_remove(self, guid, key):
+        i = bisect.bisect_left(self.pub_keys, key)
+        while self.pub_guids[i] != guid:
+            i += 1
+        del self.pub_keys[i]
+        del self.pub_guids[i]
+
+    @classmethod
+    def for_feed(cls, feed):
+        return cls(feed.store_path, feed.store_backup_path)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, guid):
+        return guid in self.data
+
+    def get(self, guid):
+        return self.data.get(guid)
+
+    def put(self, rec):
+        g = rec.guid
+        old = self.data.get(g)
+        if old is None:
+            if rec.seq is None:
+                rec.seq = self.next_seq
+            self.next_seq = max(self.next_seq, rec.seq + 1)
+            fetched = rec.fetched_at
+            if self.newest is not None and fetched < self.newest:
+                self.ordered = False  # wstawka "z przeszłości" – prune albo zapis raz posortuje
+            else:
+                self.newest = fetched
+            self._pub_insert(g, self._pub_key(rec))
+        else:
+            rec.seq = old.seq
+            if self._pub_key(old) != self._pub_key(rec):
+                self._pub_remove(g, self._pub_key(old))
+                self._pub_insert(g, self._pub_key(rec))
+        self.data[g] = rec
+
+    def prune(self, cutoff):
+        """Usuwa rekordy pobrane przed cutoff (epoch); zwraca listę usuniętych guid."""
+        self._restore_order()
+        expired = []
+        for g, rec in self.data.items():
+            if rec.fetched_at >= cutoff:
+                break
+            expired.append(g)
+        for g in expired:
+            self._pub_remove(g, self._pub_key(self.data.pop(g)))
+        return expired
+
+    def _restore_order(self):
+        # stabilne sortowanie: przy równym fetched_at zostaje kolejność dodania
+        if not self.ordered:
+            self.data = dict(sorted(self.data.items(), key=lambda kv: kv[1].fetched_at))
+            self.ordered = True
+
+    def newest_first(self):
+        return [self.data[g] for g in reversed(self.pub_guids)]
+
+    def snapshot(self):
+        """Zawartość pliku magazynu (format STORE_FORMAT), zawsze w kolejności fetched_at."""
+        self._restore_order()
+        items = {g: rec.to_json() for g, rec in self.data.items()}
+        return {"format": STORE_FORMAT, "items": items, "pub_order": self.pub_guids}
+
+    def save(self):
+        data = json_dumps(self.snapshot())
+        with atomic_write(self.path, self.backup_path, binary=True) as f:
+            f.write(data)
+
+    def close(self):
+        pass
+
+class WalStore(JsonStore):
+    """JsonStore z dopisywanym dziennikiem zmian (<magazyn>.wal, JSON Lines).
+
+    save dopisuje do dziennika tylko zmiany od poprzedniego zapisu
+    ({"seq": n, "put": rekord} albo {"seq": n, "del": [guidy]}), zamiast
+    przepisywać cały plik. Wczytanie to snapshot JsonStore plus odtworzenie
+    dziennika. Gdy dziennik urośnie ponad WAL_COMPACT_RATIO rozmiaru snapshotu,
+    save zapisuje nowy snapshot i usuwa dziennik. Snapshot pamięta numer
+    ostatniej zawartej w nim zmiany (wal_seq), a odtwarzanie pomija wpisy
+    o numerach nie większych – stary dziennik, który przetrwał awarię między
+    tymi krokami, niczego więc nie cofa. Dziennik z uszkodzonym wpisem (np.
+    linią uciętą przy awarii) jest od razu kompaktowany: dopisanie za nią
+    skleiłoby pierwszy nowy wpis z uszkodzoną linią.
+    """
+    def __init__(self, path=STORE_PATH, backup_path=STORE_BACKUP_PATH, compact_ratio=WAL_COMPACT_RATIO):
+        self.path = path
+        self.backup_path = backup_path
+        raw = load_json(path, backup_path)
+        self._load(raw)
+        self.seq = self.snapshot_seq = raw.get("wal_seq", 0)
+        self.log_path = path + ".wal"
+        self.compact_ratio = compact_ratio
+        self.pending = []
+        self.snapshot_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+        self.log_bytes = 0
+        if os.path.exists(self.log_path):
+            self.log_bytes = os.path.getsize(self.log_path)
+            if not self._replay():
+                self.compact()
+
+    def _replay(self):
+        """Odtwarza dziennik; False, gdy któryś wpis był nieczytelny."""
+        clean = True
+        with open(self.log_path, "rb") as f:
+            for n, line in enumerate(f, 1):
+                try:
+                    op = json_loads(line)
+                except (ValueError, *JSON_DECODE_ERRORS) as e:
+                    # ucięta ostatnia linia po przerwanym dopisywaniu
+                    print(f"warning: {self.log_path}:{n}: skipping bad entry: {e}", file=sys.stderr)
+                    clean = False
+                    continue
+                seq = op.get("seq")
+                if seq is not None:
+                    if seq <= self.snapshot_seq:
+                        continue  # już w snapshocie
+                    self.seq = max(self.seq, seq)
+                if "put" in op:
+                    JsonStore.put(self, Item.from_json(op["put"]))
+                else:
+                    for g in op["del"]:
+                        if g in self.data:
+                            self._pub_remove(g, self._pub_key(self.data.pop(g)))
+        return clean
+
+    def _log(self, op):
+        self.seq += 1
+        self.pending.append({"seq": self.seq, **op})
+
+    def put(self, rec):
+        super().put(rec)
+        self._log({"put": rec.to_json()})
+
+    def prune(self, cutoff):
+        expired = super().prune(cutoff)
+        if expired:
+            self._log({"del": expired})
+        return expired
+
+    def snapshot(self):
+        return {**super().snapshot(), "wal_seq": self.seq}
+
+    def save(self):
+        if not self.pending:
+            return
+        data = b"".join(json_dumps(op) + b"\n" for op in self.pending)
+        self.pending = []
+        if self.log_bytes + len(data) > self.snapshot_bytes * self.compact_ratio:
+            self.compact()
+            return
+        with open(self.log_path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.log_bytes += len(data)
+
+    def compact(self):
+        """Zapisuje pełny snapshot i zeruje dziennik."""
+        super().save()
+        self.snapshot_seq = self.seq
+        self.snapshot_bytes = os.path.getsize(self.path)
+        if os.path.exists(self.log_path):
+            os.unlink(self.log_path)
+        self.log_bytes = 0
+
+def shard_day(ts):
+    """Dzień UTC (RRRR-MM-DD) znacznika czasu – nazwa sharda."""
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
 
+class ShardedStore(JsonStore):
+    """Magazyn pocięty po dniu fetched_at: <katalog>/<dzień>.json plus manifest.json.
+
+    W pamięci działa jak JsonStore. save przepisuje tylko shardy dni, w których
+    coś się zmieniło (zwykle dzisiejszy i ewentualnie graniczny dzień retencji),
+    a dni w całości przeterminowane po prostu kasuje. Manifest (dzień -> liczba
+    rekordów) zapisujemy po shardach, więc przerwany zapis nie gubi danych
+    z poprzedniego przebiegu. Kolejność pub_order liczymy przy wczytaniu.
+
+    Manifest i shardy mają kopie .bak. Shard z manifestu, którego nie da się
+    odczytać ani odzyskać z kopii, przerywa wczytanie błędem – inaczej jego
+    dzień wyglądałby na przeterminowany i save skasowałby plik.
+
+    Bez manifestu magazyn jest jednorazowo migrowany z pliku JsonStore
+    (legacy_path); stary plik zostaje na dysku nietknięty.
+    """
+    MANIFEST = "manifest.json"
+
+    def __init__(self, directory=SHARD_DIR, legacy_path=STORE_PATH):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, self.MANIFEST)
+        self.dirty = set()
+        if os.path.exists(self.manifest_path):
+            manifest = load_json(self.manifest_path, self.manifest_path + ".bak")
+            if "shards" not in manifest:
+                raise ValueError(f"{self.manifest_path}: unreadable shard manifest")
+            self.shards = manifest["shards"]
+            items = {}
+            for day in sorted(self.shards):
+                path = self.shard_path(day)
+                shard = load_json(path, path + ".bak")
+                if not shard and self.shards[day]:
+                    raise ValueError(f"{path}: shard listed in {self.manifest_path} "
+                                     "is missing or unreadable")
+                items.update(shard)
+            self._load(items)
+        else:
+            self.shards = {}
+            self._load(load_json(legacy_path, legacy_path + ".bak") if legacy_path else {})
+
+    @classmethod
+    def for_feed(cls, feed):
+        return cls(feed.shard_dir, feed.store_path)
+
+    def shard_path(self, day):
+        return os.path.join(self.directory, day + ".json")
+
+    def put(self, rec):
+        self.dirty.add(shard_day(rec.fetched_at))
+        super().put(rec)
+
+    def save(self):
+        self._restore_order()
+        days = {}
+        for g, rec in self.data.items():
+            days.setdefault(shard_day(rec.fetched_at), {})[g] = rec
+        # prune nie znaczy dni jako brudne – zmianę widać po liczbie rekordów
+        changed = {day for day, recs in days.items()
+                   if day in self.dirty or self.shards.get(day) != len(recs)}
+        expired = [day for day in self.shards if day not in days]
+        if not changed and not expired:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for day in sorted(changed):
+            data = json_dumps({g: rec.to_json() for g, rec in days[day].items()})
+            path = self.shard_path(day)
+            with atomic_write(path, path + ".bak", binary=True) as f:
+                f.write(data)
+        self.shards = {day: len(days[day]) for day in sorted(days)}
+        with atomic_write(self.manifest_path, self.manifest_path + ".bak") as f:
+            json.dump({"format": 1, "shards": self.shards}, f, indent=1)
+        for day in expired:
+            for path in (self.shard_path(day), self.shard_path(day) + ".bak"):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+        self.dirty.clear()
+
+class SqliteStore:
+    """Magazyn w SQLite: upsert i retencja to operacje na pojedynczych wierszach.
+
+    Rekord leży w kolumnie record (JSON); guid, fetched_at i pubDate są
+    osobnymi, indeksowanymi kolumnami. Nowo założona baza jest jednorazowo
+    wypełniana z pliku JsonStore (legacy_path), jeśli ten istnieje.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS items (
+            guid TEXT PRIMARY KEY,
+            fetched_at REAL NOT NULL,
+            pub_date REAL,
+            record TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS items_fetched_at ON items (fetched_at);
+        CREATE INDEX IF NOT EXISTS items_pub_date ON items (pub_date);
+        CREATE INDEX IF NOT EXISTS items_pub_order ON items (coalesce(pub_date, fetched_at));
+    """
+    FETCH_ROWS = 256  # newest_first: wierszy na jedno pobranie z kursora
+
+    def __init__(self, path=SQLITE_PATH, legacy_path=STORE_PATH):
+        self.path = path
+        fresh = not os.path.exists(path)
+        # EnrichmentCache innego feedu może czytać z tego magazynu w swoim wątku
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.executescript(self.SCHEMA)
+        if fresh and legacy_path and os.path.exists(legacy_path):
+            self._import(JsonStore(legacy_path, legacy_path + ".bak"))
+
+    def _import(self, store):
+        # kolejność seq – rowid odtwarza kolejność dodania
+        for rec in sorted(store.data.values(), key=lambda rec: rec.seq):
+            self.put(rec)
+        self.save()
+
+    @classmethod
+    def for_feed(cls, feed):
+        return cls(feed.sqlite_path, feed.store_path)
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM items")[0][0]
+
+    def __contains__(self, guid):
+        return bool(self._query("SELECT 1 FROM items WHERE guid = ?", (guid,)))
+
+    def get(self, guid):
+        rows = self._query("SELECT record FROM items WHERE guid = ?", (guid,))
+        return Item.from_json(json_loads(rows[0][0])) if rows else None
+
+    def put(self, rec):
+        # upsert zamiast REPLACE: wiersz zachowuje rowid, czyli kolejność dodania
+        self._query(
+            "INSERT INTO items (guid, fetched_at, pub_date, record) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (guid) DO UPDATE SET fetched_at = excluded.fetched_at, "
+            "pub_date = excluded.pub_date, record = excluded.record",
+            (rec.guid, rec.fetched_at, rec.pub_date, json_dumps(rec.to_json()).decode("utf-8")))
+
+    def prune(self, cutoff):
+        limit = (cutoff,)
+        expired = [g for (g,) in self._query("SELECT guid FROM items WHERE fetched_at < ?", limit)]
+        self._query("DELETE FROM items WHERE fetched_at < ?", limit)
+        return expired
+
+    def newest_first(self):
+        # kursor czytany porcjami: pamięć build_rss nie rośnie z rozmiarem tabeli
+        with self.lock:
+            cur = self.db.execute(
+                "SELECT record FROM items ORDER BY coalesce(pub_date, fetched_at) DESC, rowid")
+        try:
+            while True:
+                with self.lock:
+                    rows = cur.fetchmany(self.FETCH_ROWS)
+                if not rows:
+                    return
+                for (r,) in rows:
+                    yield Item.from_json(json_loads(r))
+        finally:
+            with self.lock:
+                cur.close()
+
+    def save(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+STORE_BACKENDS = {"json": JsonStore, "wal": WalStore, "sharded": ShardedStore, "sqlite": SqliteStore}
+
+@timed("load_store")
+def load_store(feed=None):
+    feed = feed or default_feed()
+    return STORE_BACKENDS[feed.backend].for_feed(feed)
+
+@timed("save_store")
 def save_store(store):
-    with open(STORE_PATH, "w", encoding="utf-8") as f:
-        json.dump(store, f, ensure_ascii=False)
+    store.save()
+
+def load_state(feed=None):
+    return load_json((feed or default_feed()).state_path)
+
+def save_state(state, feed=None):
+    with atomic_write((feed or default_feed()).state_path) as f:
+        json.dump(state, f, ensure_ascii=False, indent=1, sort_keys=True)
 
 # --- Pobranie i parsowanie RSS -----------------------------------------------
-def fetch_feed_xml(url: str) -> bytes:
-    req = Request(url, headers={"User-Agent": "Mozilla/5.0 (RSS cache)"})
-    with urlopen(req, timeout=30) as resp:
-        return resp.read()
+@timed("fetch_feed_xml")
+def fetch_feed_xml(url: str, validators=None):
+    """Pobiera feed. Z validators wysyła zapytanie warunkowe.
 
+    validators to słownik {"etag", "last_modified"} – zostaje uzupełniony
+    nagłówkami odpowiedzi. Przy 304 Not Modified zwraca None.
+    """
+    headers = {}
+    if validators is not None:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    with HTTP_POOL.get(url, headers=headers, timeout=30) as resp:
+        body = resp.read()
+        METRICS.count("feed_bytes", len(body))
+        if resp.status == 304:
+            return None
+        if validators is not None:
+            validators.clear()
+            for key, header in (("etag", "ETag"), ("last_modified", "Last-Modified")):
+                if resp.getheader(header):
+                    validators[key] = resp.getheader(header)
+        return body
+
+@timed("parse_rss_items")
 def parse_rss_items(xml_bytes: bytes):
     root = ET.fromstring(xml_bytes)
     items = []
@@ -123,7 +1209,7 @@ def clean_description(desc: str) -> str:
     # usuń JEDEN końcowy ']' wraz z poprzedzającymi spacjami
     return re.sub(r"\s*\]\s*$", "", desc)
 
-def extract_item_data(it):
+def extract_item_data(it, fetch_og=True):
     title = text(it, "title")
     link = text(it, "link")
 
@@ -136,16 +1222,16 @@ def extract_item_data(it):
     enc_el = it.find("enclosure")
     enclosure = None
     if enc_el is not None:
-        enclosure = {
-            "url": enc_el.attrib.get("url", ""),
-            "length": enc_el.attrib.get("length", ""),
-            "type": enc_el.attrib.get("type", ""),
-        }
-
-    # PRÓBA: większy obrazek z og:image
-    if link:
+        enclosure = Enclosure(
+            enc_el.attrib.get("url", ""),
+            enc_el.attrib.get("length", ""),
+            enc_el.attrib.get("type", ""),
+        )
+
+    # PRÓBA: większy obrazek z og:image (fetch_og=False -> robi to enrich_items)
+    if fetch_og and link:
         og_enc = fetch_og_image(link)
-        if og_enc and og_enc.get("url"):
+        if og_enc and og_enc.url:
             enclosure = og_enc  # preferujemy og:image
 
     raw_guid = text(it, "guid")
@@ -154,103 +1240,607 @@ def extract_item_data(it):
     pub_date_raw = text(it, "pubDate")
     pub_date = parse_pubdate(pub_date_raw)
 
-    return {
-        "guid": guid,
-        "title": title,
-        "link": link,
-        "description": description,
-        "enclosure": enclosure,
-        "pubDate_raw": pub_date_raw,
-        "pubDate": pub_date.isoformat() if pub_date else None,
-    }
+    return Item(
+        guid=guid,
+        title=title,
+        link=link,
+        description=description,
+        enclosure=enclosure,
+        pub_date_raw=pub_date_raw,
+        pub_date=to_epoch(pub_date) if pub_date else None,
+    )
+
+# --- Równoległe wzbogacanie og:image -----------------------------------------
+class EnrichmentCache:
+    """Udane wyniki og:image z poprzednich przebiegów (klucz: guid, zapasowo link).
+
+    Rekord w magazynie niesie og_checked_at (kiedy sprawdzano stronę) i og_ok
+    (czy enclosure pochodzi z og:image). Nieudane i przeterminowane wpisy
+    traktujemy jak brak w cache – zostaną pobrane ponownie. Magazyny są
+    odpytywane po guid na żądanie, więc cache nie wczytuje ich w całości.
+
+    Pobrania idą przez własną pulę cache (workers wątków na cały przebieg):
+    na jedno pobranie może czekać kilka feedów, więc deadline jednego z nich
+    niczego nie anuluje. Pula kończy się w close, na końcu przebiegu.
+    """
+    def __init__(self, stores=(), ttl_hours=ENRICH_TTL_HOURS, workers=ENRICH_WORKERS):
+        self.ttl = int(ttl_hours * 3600)
+        self.stores = list(stores)
+        self.by_link = {}
+        self.inflight = {}  # link -> Future; feedy dzielą pobrania w ramach przebiegu
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+
+    def fetch(self, link):
+        """Future z og:image dla linku – zlecane tylko raz na przebieg."""
+        with self.lock:
+            fut = self.inflight.get(link)
+            if fut is None:
+                # kontekst zlecającego (zakres METRICS feedu) idzie z zadaniem do wątku
+                fut = self.inflight[link] = self.pool.submit(
+                    contextvars.copy_context().run, fetch_og_image, link)
+        return fut
+
+    def attach(self, store):
+        with self.lock:
+            self.stores.append(store)
+
+    def detach(self, store):
+        """Odłącza magazyn; po powrocie żaden lookup już go nie czyta i można go zamknąć."""
+        with self.lock:
+            self.stores.remove(store)
+
+    def close(self):
+        """Porzuca pobrania, na które nikt już nie czeka (koniec przebiegu)."""
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def usable(rec, link):
+        return bool(rec and rec.og_ok and rec.og_checked_at
+                    and rec.enclosure and rec.enclosure.url and rec.link == link)
+
+    def add(self, rec):
+        if rec.link and self.usable(rec, rec.link):
+            self.by_link[rec.link] = rec
+
+    def lookup(self, guid, link, now=None):
+        """Zwraca zapisany rekord z aktualnym og:image albo None."""
+        rec = None
+        if guid:
+            with self.lock:  # inny feed może właśnie odłączać i zamykać swój magazyn
+                for store in self.stores:
+                    rec = store.get(guid)
+                    if rec is not None:
+                        break
+        if not self.usable(rec, link):
+            rec = self.by_link.get(link)
+        if rec is None:
+            return None
+        if rec.og_checked_at + self.ttl < (now or epoch_now()):
+            return None
+        return rec
+
+@timed("enrich_items")
+def enrich_items(items_data, cache=None, workers=ENRICH_WORKERS, deadline=ENRICH_DEADLINE):
+    """Pobiera og:image dla wszystkich pozycji naraz (pula wątków, globalny deadline).
+
+    Wynik jest taki sam jak w ścieżce szeregowej extract_item_data: og:image
+    zastępuje enclosure z feedu, a błąd lub przekroczony deadline zostawia
+    enclosure z feedu bez zmian. Pozycje trafione w cache nie generują ruchu HTTP.
+    Pobrania idą przez pulę cache; bez cache przez tymczasowy na workers wątków.
+    """
+    owned = cache is None
+    if owned:
+        cache = EnrichmentCache(workers=workers)
+    try:
+        now = epoch_now()
+        by_link = enrich_lookup(items_data, cache, now)
+        if by_link:
+            # pobrania należą do cache – mogą na nie czekać inne feedy, więc ich nie anulujemy
+            futures = {cache.fetch(link): link for link in by_link}
+            done, _ = wait(futures, timeout=deadline)
+            enrich_apply(futures, done, by_link, cache, now)
+    finally:
+        if owned:
+            cache.close()
+    return items_data
+
+def enrich_lookup(items_data, cache, now):
+    """Uzupełnia pozycje trafione w cache; zwraca link -> pozycje do pobrania."""
+    by_link = {}
+    for d in items_data:
+        link = d.link
+        if not link:
+            continue
+        hit = cache.lookup(d.guid, link, now)
+        if hit is not None:
+            METRICS.count("enrich_hit")
+            d.enclosure = hit.enclosure
+            d.og_checked_at = hit.og_checked_at
+            d.og_ok = True
+        else:
+            METRICS.count("enrich_miss")
+            by_link.setdefault(link, []).append(d)
+    return by_link
+
+def enrich_apply(futures, done, by_link, cache, checked_at):
+    """Wpisuje wyniki pobrań (future -> link) do pozycji; niedokończone zostawia."""
+    for fut, link in futures.items():
+        og_enc = fut.result() if fut in done and not fut.cancelled() else None
+        ok = bool(og_enc and og_enc.url)
+        if fut not in done:
+            METRICS.count("enrich_timeout", len(by_link[link]))
+        elif not ok:
+            METRICS.count("enrich_failure", len(by_link[link]))
+        for d in by_link[link]:
+            if ok:
+                d.enclosure = og_enc
+            d.og_checked_at = checked_at
+            d.og_ok = ok
+            cache.add(d)
 
 # --- Retencja i upsert --------------------------------------------------------
-def prune_store(store):
-    cutoff = now_utc() - timedelta(days=RETENTION_DAYS)
-    to_delete = []
-    for g, rec in list(store.items()):
-        fetched_at = datetime.fromisoformat(rec["fetched_at"])
-        if fetched_at < cutoff:
-            to_delete.append(g)
-    for g in to_delete:
-        del store[g]
+@timed("prune_store")
+def prune_store(store, retention_days=RETENTION_DAYS):
+    cutoff = epoch_now() - retention_days * 86400
+    return store.prune(cutoff)
 
+class ChangeSet:
+    """Wynik upsert_items: guidy wstawione, zmienione i bez zmian."""
+    __slots__ = ("inserted", "updated", "unchanged")
+
+    def __init__(self):
+        self.inserted = []
+        self.updated = []
+        self.unchanged = []
+
+    def __bool__(self):
+        return bool(self.inserted or self.updated)
+
+@timed("upsert_items")
 def upsert_items(store, items_data):
-    fetched = nowiso()
+    """Wstawia nowe pozycje i nadpisuje zmienione; identycznych nie dotyka."""
+    fetched = epoch_now()
+    changes = ChangeSet()
     for d in items_data:
-        g = d["guid"]
-        if not g:
+        if not d.guid:
             continue
-        if g not in store:
-            store[g] = {**d, "fetched_at": fetched}
+        rec = store.get(d.guid)
+        if rec is None:
+            d.fetched_at = fetched
+            store.put(d)
+            changes.inserted.append(d.guid)
+            continue
+        new = rec.merged(d)
+        if new.og_ok is False and rec.og_ok is False:
+            # kolejna nieudana próba og:image nie jest zmianą rekordu
+            new.og_checked_at = rec.og_checked_at
+        if new == rec:
+            changes.unchanged.append(d.guid)
         else:
-            store[g].update({k: d[k] for k in d if k not in ("guid", "fetched_at")})
+            store.put(new)
+            changes.updated.append(d.guid)
+    return changes
 
 # --- Budowa RSS 2.0 -----------------------------------------------------------
-def build_rss(store):
-    rss = ET.Element("rss", attrib={"version": "2.0"})
-    channel = ET.SubElement(rss, "channel")
-    ET.SubElement(channel, "title").text = "Newsweek – cache (5h, 7 dni)"
-    ET.SubElement(channel, "link").text = "https://www.newsweek.pl/"
-    ET.SubElement(channel, "description").text = "Lustrzany cache jednego feedu, odświeżany co 5 godzin"
-    ET.SubElement(channel, "lastBuildDate").text = email.utils.format_datetime(now_utc())
-
-    def sort_key(rec):
-        pd = rec.get("pubDate")
-        if pd:
+ATOM_NS = "http://www.w3.org/2005/Atom"
+FH_NS = "http://purl.org/syndication/history/1.0"  # RFC 5005
+
+def xml_text(s):
+    return xml_escape(s)
+
+def xml_attr(s):
+    return xml_escape(s, {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#09;"})
+
+def xml_cdata(s):
+    # "]]>" w treści musi rozciąć sekcję CDATA na dwie
+    return "<![CDATA[" + s.replace("]]>", "]]]]><![CDATA[>") + "]]]>"
+
+def write_rss(f, feed, records, build_date, links=(), archive=False):
+    """Strumieniowo zapisuje kanał RSS 2.0 do otwartego pliku tekstowego.
+
+    Pozycje trafiają do pliku od razu, bez budowania drzewa w pamięci;
+    opis idzie jako natywna sekcja CDATA. Przy stronicowaniu (feed.current_items)
+    kanał dostaje linki atom:link (rel, href) i – na stronie archiwum – fh:archive.
+    """
+    w = f.write
+    w('<?xml version="1.0" encoding="UTF-8"?>\n')
+    if feed.current_items:
+        w(f'<rss version="2.0" xmlns:atom="{ATOM_NS}" xmlns:fh="{FH_NS}"><channel>')
+    else:
+        w('<rss version="2.0"><channel>')
+    w(f"<title>{xml_text(feed.title)}</title>")
+    w(f"<link>{xml_text(feed.link)}</link>")
+    w(f"<description>{xml_text(feed.description)}</description>")
+    if build_date is not None:
+        w(f"<lastBuildDate>{email.utils.format_datetime(build_date)}</lastBuildDate>")
+    for rel, href in links:
+        w(f'<atom:link rel="{rel}" href="{xml_attr(href)}" />')
+    if archive:
+        w("<fh:archive />")
+    for rec in records:
+        w("<item>")
+        if rec.title:
+            w(f"<title>{xml_text(rec.title)}</title>")
+        if rec.link:
+            w(f"<link>{xml_text(rec.link)}</link>")
+        if rec.description:
+            w(f"<description>{xml_cdata(rec.description)}</description>")
+        enc = rec.enclosure
+        if enc and enc.url:
+            attrs = "".join(f' {k}="{xml_attr(str(v))}"'
+                            for k, v in (("url", enc.url), ("length", enc.length), ("type", enc.type))
+                            if v is not None)
+            w(f"<enclosure{attrs} />")
+        if rec.pub_date_raw:
+            w(f"<pubDate>{xml_text(rec.pub_date_raw)}</pubDate>")
+        if rec.guid:
+            w(f"<guid>{xml_text(rec.guid)}</guid>")
+        w("</item>")
+    w("</channel></rss>")
+
+def rss_build_date(newest):
+    """lastBuildDate dokumentu; w trybie deterministycznym czas najnowszej pozycji.
+
+    newest to pierwsza pozycja dokumentu (kolejność kanału) albo None dla
+    pustego dokumentu – ten nie ma wtedy lastBuildDate (element jest opcjonalny).
+    """
+    if not DETERMINISTIC_OUTPUT:
+        return now_utc()
+    if newest is None:
+        return None
+    return datetime.fromtimestamp(pub_sort_key(newest), timezone.utc)
+
+def peek(records):
+    """Pierwszy rekord i iterator po wszystkich, łącznie z nim (None dla pustych)."""
+    it = iter(records)
+    first = next(it, None)
+    return first, (it if first is None else itertools.chain((first,), it))
+
+def rss_fingerprint(feed, records):
+    """Skrót wszystkiego, co trafia do XML poza lastBuildDate."""
+    h = hashlib.sha256()
+    meta = [feed.title, feed.link, feed.description]
+    if feed.current_items:
+        meta += [feed.current_items, ARCHIVE_BASE_URL]
+    h.update(json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+    for rec in records:
+        enc = rec.enclosure or Enclosure(None, None, None)
+        fields = [rec.title, rec.link, rec.description, enc.url, enc.length, enc.type,
+                  rec.pub_date_raw, rec.guid]
+        h.update(json.dumps(fields, ensure_ascii=False).encode("utf-8"))
+    return h.hexdigest()
+
+def compressed_paths(path):
+    """Ścieżki skompresowanych kopii pliku wyjściowego."""
+    paths = []
+    if OUTPUT_GZIP:
+        paths.append(path + ".gz")
+    if OUTPUT_BROTLI and brotli is not None:
+        paths.append(path + ".br")
+    return paths
+
+COMPRESS_CHUNK_SIZE = 64 * 1024
+# ID, CM=deflate, FLG=0, MTIME=0, XFL=2 (max. kompresja), OS=255 (nieznany)
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff"
+
+def gzip_stream(src, dst):
+    """gzip bez czasu modyfikacji i nazwy pliku, z nagłówkiem stałym między wersjami Pythona."""
+    co = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = size = 0
+    dst.write(GZIP_HEADER)
+    for chunk in iter(lambda: src.read(COMPRESS_CHUNK_SIZE), b""):
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        dst.write(co.compress(chunk))
+    dst.write(co.flush())
+    dst.write(struct.pack("<II", crc, size & 0xFFFFFFFF))
+
+def brotli_stream(src, dst):
+    c = brotli.Compressor(quality=11)
+    for chunk in iter(lambda: src.read(COMPRESS_CHUNK_SIZE), b""):
+        dst.write(c.process(chunk))
+    dst.write(c.finish())
+
+def output_files(path):
+    """Plik wyjściowy razem z jego skompresowanymi kopiami."""
+    return [path, *compressed_paths(path)]
+
+def write_compressed(path):
+    """Zapisuje kopie .gz/.br gotowego pliku; ten sam XML daje te same bajty.
+
+    Plik czytamy porcjami, więc pamięć nie rośnie z rozmiarem wyjścia.
+    """
+    with METRICS.stage("compress_output"):
+        for target in compressed_paths(path):
+            compress = gzip_stream if target.endswith(".gz") else brotli_stream
+            with open(path, "rb") as src, atomic_write(target, binary=True) as dst:
+                compress(src, dst)
+
+def archive_path(feed, day):
+    root, ext = os.path.splitext(feed.output_path)
+    return f"{root}-{day}{ext}"
+
+def archive_url(path):
+    return urljoin(ARCHIVE_BASE_URL, os.path.basename(path))
+
+def write_archives(feed, store, archives):
+    """Odkłada starsze pozycje na dzienne strony archiwum RFC 5005.
+
+    Dni publikacji starsze od dnia feed.current_items-tej najnowszej pozycji
+    (i nowsze od ostatniej strony archiwum) dostają własną stronę, zapisywaną
+    raz i potem już nie zmienianą. archives (dzień -> guidy strony) to stan
+    przechowywany między przebiegami. Strona znika, gdy magazyn usunie
+    wszystkie jej pozycje. Zwraca pozycje bieżącego dokumentu (iterator)
+    i listę jego linków; spóźnione pozycje z dni już zarchiwizowanych zostają
+    w bieżącym. Magazyn przechodzimy kilka razy zamiast trzymać go w pamięci;
+    naraz w pamięci jest najwyżej jeden dzień zapisywanej strony.
+    """
+    last = max(archives, default="")
+    paged = {g for guids in archives.values() for g in guids}
+    boundary, new, live = None, set(), set()  # live: guidy stron archiwum wciąż w magazynie
+    for n, rec in enumerate(store.newest_first(), 1):
+        day = shard_day(pub_sort_key(rec))
+        if n == feed.current_items:
+            boundary = day
+        elif boundary is not None and last < day < boundary:
+            new.add(day)
+        if rec.guid in paged:
+            live.add(rec.guid)
+    prev = {}  # nowy dzień archiwum -> poprzednia (starsza) strona
+    if new:
+        days = sorted(new)
+        prev = dict(zip(days, [last] + days[:-1]))
+        for day, group in itertools.groupby(store.newest_first(), lambda rec: shard_day(pub_sort_key(rec))):
+            if day < days[0]:
+                break
+            if day not in prev:
+                continue
+            recs = list(group)
+            links = [("current", archive_url(feed.output_path))]
+            if prev[day]:
+                links.append(("prev-archive", archive_url(archive_path(feed, prev[day]))))
+            with atomic_write(archive_path(feed, day)) as f:
+                write_rss(f, feed, recs, rss_build_date(recs[0]), links, archive=True)
+            write_compressed(archive_path(feed, day))
+            archives[day] = [rec.guid for rec in recs]
+    for day in [d for d, guids in archives.items() if d not in prev and live.isdisjoint(guids)]:
+        del archives[day]
+        path = archive_path(feed, day)
+        for target in output_files(path):
             try:
-                return datetime.fromisoformat(pd)
-            except Exception:
+                os.unlink(target)
+            except FileNotFoundError:
                 pass
-        return datetime.fromisoformat(rec["fetched_at"])
-
-    for _, rec in sorted(store.items(), key=lambda kv: sort_key(kv[1]), reverse=True):
-        it = ET.SubElement(channel, "item")
-        if rec.get("title"):
-            ET.SubElement(it, "title").text = rec["title"]
-        if rec.get("link"):
-            ET.SubElement(it, "link").text = rec["link"]
-
-        desc_text = rec.get("description") or ""
-        if desc_text:
-            d = ET.SubElement(it, "description")
-            # ElementTree nie ma natywnego CDATA – wstawiamy placeholder i zamienimy później
-            d.text = f"__CDATA_PLACEHOLDER_START__{desc_text}__CDATA_PLACEHOLDER_END__"
-
-        enc = rec.get("enclosure")
-        if enc and enc.get("url"):
-            enc_el = ET.SubElement(it, "enclosure")
-            for k in ("url", "length", "type"):
-                v = enc.get(k)
-                if v is not None:
-                    enc_el.set(k, str(v))
-
-        if rec.get("pubDate_raw"):
-            ET.SubElement(it, "pubDate").text = rec["pubDate_raw"]
-
-        if rec.get("guid"):
-            ET.SubElement(it, "guid").text = rec["guid"]
-
-    # Serializacja z deklaracją XML + CDATA
-    tree = ET.ElementTree(rss)
-    xml_bytes = ET.tostring(tree.getroot(), encoding="utf-8")
-    xml_str = xml_bytes.decode("utf-8")
-    xml_str = xml_str.replace("__CDATA_PLACEHOLDER_START__", "<![CDATA[")
-    xml_str = xml_str.replace("__CDATA_PLACEHOLDER_END__", "]]]>")
-    with open(OUTPUT_PATH, "w", encoding="utf-8") as f:
-        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        f.write(xml_str)
+    archived = {g for guids in archives.values() for g in guids}
+    links = [("prev-archive", archive_url(archive_path(feed, max(archives))))] if archives else []
+    return (rec for rec in store.newest_first() if rec.guid not in archived), links
+
+@timed("build_rss")
+def build_rss(store, state=None, feed=None):
+    """Zapisuje plik wyjściowy feedu; zwraca False, jeśli został nietknięty.
+
+    Bajty wyjścia zależą tylko od magazynu (DETERMINISTIC_OUTPUT), więc
+    z przekazanym state (słownik) wystarczy porównać odcisk pozycji
+    z poprzednim przebiegiem: przy braku zmian plik i jego kopie zostają
+    nietknięte, bez renderowania XML i kompresji. Przy feed.current_items
+    obok powstają strony archiwum (write_archives).
+    """
+    feed = feed or default_feed()
+    if state is not None:
+        fingerprint = rss_fingerprint(feed, store.newest_first())
+        outputs = output_files(feed.output_path)
+        if state.get("fingerprint") == fingerprint and all(map(os.path.exists, outputs)):
+            return False
+        state["fingerprint"] = fingerprint
+
+    records, links = store.newest_first(), ()  # magazyn trzyma kolejność publikacji
+    if feed.current_items:
+        archives = state.setdefault("archives", {}) if state is not None else {}
+        records, links = write_archives(feed, store, archives)
+    newest, records = peek(records)
+    with atomic_write(feed.output_path) as f:
+        write_rss(f, feed, records, rss_build_date(newest), links)
+    write_compressed(feed.output_path)
+    return True
 
 # --- main ---------------------------------------------------------------------
 def main():
-    store = load_store()
-    prune_store(store)
-    xml = fetch_feed_xml(FEED_URL)
-    items = parse_rss_items(xml)
-    parsed = [extract_item_data(it) for it in items]
-    upsert_items(store, parsed)
-    save_store(store)
-    build_rss(store)
+    if ASYNC_PIPELINE:
+        asyncio.run(main_async())
+        return
+    feeds = load_feeds()
+    if OUTPUT_BROTLI and brotli is None:
+        print("warning: OUTPUT_BROTLI is set but brotli is not installed; skipping .br", file=sys.stderr)
+    workers = max(1, min(FEED_WORKERS, len(feeds)))
+    # wspólny dla wszystkich feedów (jak HTTP_POOL), z pulą na tyle wątków, ile miały feedy osobno
+    cache = EnrichmentCache(workers=ENRICH_WORKERS * workers)
+    METRICS.reset()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(run_feed, feed, cache): feed for feed in feeds}
+        raise_feed_errors(feeds, [fut.exception() for fut in futures])
+    finally:
+        cache.close()
+        HTTP_POOL.close()
+        METRICS.write(RUN_REPORT_PATH)
+
+def raise_feed_errors(feeds, errors):
+    """Wypisuje błędy feedów i rzuca pierwszy z nich (pozostałe feedy już przeszły)."""
+    for feed, err in zip(feeds, errors):
+        if err is not None:
+            print(f"error: feed {feed.name}: {err!r}", file=sys.stderr)
+    errors = [err for err in errors if err is not None]
+    if errors:
+        raise errors[0]
+
+def run_feed(feed, cache=None):
+    """Pełny przebieg dla jednego feedu: pobranie, og:image, magazyn, XML."""
+    with METRICS.scope(feed.name), METRICS.stage("run_feed"):
+        _run_feed(feed, cache)
+
+def _run_feed(feed, cache):
+    for path in (feed.store_path, feed.state_path, feed.output_path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    state = load_state(feed)
+    xml = fetch_feed_xml(feed.url, state.setdefault("feed", {}))
+    if xml is None:
+        # 304: feed bez zmian – magazyn i XML zostają jak po poprzednim przebiegu
+        METRICS.count("feed_not_modified")
+        if all(map(os.path.exists, output_files(feed.output_path))):
+            return
+    owned = cache is None
+    if owned:
+        cache = EnrichmentCache()
+    store = load_store(feed)
+    cache.attach(store)
+    try:
+        if xml is None:
+            # brakuje pliku wyjściowego albo kopii (np. po włączeniu .gz) – odbudowa z magazynu
+            if build_rss(store, state.setdefault("output", {}), feed):
+                METRICS.count("output_written")
+        else:
+            pruned = prune_store(store, feed.retention_days)
+            METRICS.count("pruned", len(pruned))
+            items = parse_rss_items(xml)
+            with METRICS.stage("extract_item_data"):
+                parsed = [extract_item_data(it, fetch_og=False) for it in items]
+            METRICS.count("feed_items", len(parsed))
+            enrich_items(parsed, cache)
+            changes = upsert_items(store, parsed)
+            if store_changed(feed, store, changes, pruned):
+                save_store(store)
+                if build_rss(store, state.setdefault("output", {}), feed):
+                    METRICS.count("output_written")
+    finally:
+        cache.detach(store)
+        store.close()
+        if owned:
+            cache.close()
+    save_state(state, feed)  # walidatory zapisujemy dopiero po udanym przebiegu
+
+def store_changed(feed, store, changes, pruned):
+    """Liczniki upsertu; False, gdy magazyn i pliki wyjściowe nie wymagają zapisu."""
+    for name in ChangeSet.__slots__:
+        METRICS.count(name, len(getattr(changes, name)))
+    METRICS.count("store_records", len(store))
+    if not changes and not pruned and all(map(os.path.exists, output_files(feed.output_path))):
+        # magazyn bez zmian – ani zapisu, ani przebudowy XML
+        METRICS.count("store_unchanged")
+        return False
+    return True
+
+# --- Potok asyncio ------------------------------------------------------------
+# Ten sam przebieg co run_feed, ale etapy niezależne od siebie idą naraz:
+# pobranie feedu z wczytaniem magazynu i strony artykułów pod semaforem.
+# Zapis magazynu i budowa XML idą po kolei, jak w run_feed – plik wyjściowy
+# nie może wyprzedzić magazynu. Blokujące I/O i parsowanie działają
+# w asyncio.to_thread, więc feedy nie blokują sobie pętli zdarzeń.
+async def main_async():
+    feeds = load_feeds()
+    if OUTPUT_BROTLI and brotli is None:
+        print("warning: OUTPUT_BROTLI is set but brotli is not installed; skipping .br", file=sys.stderr)
+    cache = EnrichmentCache(workers=ENRICH_WORKERS * max(1, min(FEED_WORKERS, len(feeds))))
+    METRICS.reset()
+    try:
+        sem = asyncio.Semaphore(max(1, FEED_WORKERS))
+
+        async def limited(feed):
+            async with sem:
+                await run_feed_async(feed, cache)
+
+        results = await asyncio.gather(*map(limited, feeds), return_exceptions=True)
+        raise_feed_errors(feeds, results)
+    finally:
+        cache.close()
+        HTTP_POOL.close()
+        METRICS.write(RUN_REPORT_PATH)
+
+async def run_feed_async(feed, cache=None):
+    """Odpowiednik run_feed dla pętli asyncio."""
+    with METRICS.scope(feed.name), METRICS.stage("run_feed"):
+        await _run_feed_async(feed, cache)
+
+async def _run_feed_async(feed, cache):
+    for path in (feed.store_path, feed.state_path, feed.output_path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    state = load_state(feed)
+    # magazyn wczytujemy w tle; przy 304 zostanie po prostu zamknięty
+    loading = asyncio.ensure_future(asyncio.to_thread(load_store, feed))
+    try:
+        xml = await asyncio.to_thread(fetch_feed_xml, feed.url, state.setdefault("feed", {}))
+    except BaseException:
+        # zgłaszamy błąd pobrania; magazyn wczytany w tle tylko zamykamy
+        try:
+            (await loading).close()
+        except Exception:
+            pass  # błąd wczytania jest tu wtórny
+        raise
+    store = await loading
+    owned = cache is None
+    if owned:
+        cache = EnrichmentCache()
+    cache.attach(store)
+    try:
+        if xml is None:
+            METRICS.count("feed_not_modified")
+            if all(map(os.path.exists, output_files(feed.output_path))):
+                return
+            # jak w _run_feed: odbudowa brakujących plików wyjściowych z magazynu
+            if await asyncio.to_thread(build_rss, store, state.setdefault("output", {}), feed):
+                METRICS.count("output_written")
+        else:
+            pruned = await asyncio.to_thread(prune_store, store, feed.retention_days)
+            METRICS.count("pruned", len(pruned))
+            items = await asyncio.to_thread(parse_rss_items, xml)
+            with METRICS.stage("extract_item_data"):
+                parsed = [extract_item_data(it, fetch_og=False) for it in items]
+            METRICS.count("feed_items", len(parsed))
+            await enrich_items_async(parsed, cache)
+            changes = await asyncio.to_thread(upsert_items, store, parsed)
+            if store_changed(feed, store, changes, pruned):
+                # jak w _run_feed: XML dopiero po udanym zapisie magazynu, żaden
+                # wątek nie czyta już magazynu, gdy finally go zamyka
+                await asyncio.to_thread(save_store, store)
+                if await asyncio.to_thread(build_rss, store, state.setdefault("output", {}), feed):
+                    METRICS.count("output_written")
+    finally:
+        cache.detach(store)
+        store.close()
+        if owned:
+            cache.close()
+    save_state(state, feed)
+
+@timed("enrich_items")
+async def enrich_items_async(items_data, cache=None, workers=ENRICH_WORKERS, deadline=ENRICH_DEADLINE):
+    """enrich_items dla asyncio: feed zleca najwyżej workers pobrań naraz, wspólny deadline.
+
+    Pobrania idą przez pulę cache, jak w enrich_items. Po deadline feed
+    przestaje zlecać kolejne; już zlecone dokańczają się dla innych feedów.
+    """
+    owned = cache is None
+    if owned:
+        cache = EnrichmentCache(workers=workers)
+    try:
+        now = epoch_now()
+        by_link = enrich_lookup(items_data, cache, now)
+        if by_link:
+            sem = asyncio.Semaphore(max(1, workers))
+
+            async def fetch(link):
+                async with sem:
+                    # shield: anulowanie po deadline nie anuluje pobrania, na które czeka inny feed
+                    return await asyncio.shield(asyncio.wrap_future(cache.fetch(link)))
+
+            futures = {asyncio.ensure_future(fetch(link)): link for link in by_link}
+            done, pending = await asyncio.wait(futures, timeout=deadline)
+            for fut in pending:
+                fut.cancel()
+            enrich_apply(futures, done, by_link, cache, now)
+    finally:
+        if owned:
+            cache.close()
+    return items_data
 
 if __name__ == "__main__":
     main()